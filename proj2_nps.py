@@ -3,21 +3,85 @@
 ##### Uniqname: skenkre     #####
 #################################
 
-from bs4 import BeautifulSoup
+import atexit
+import codecs
+from concurrent.futures import Future, ThreadPoolExecutor
+from lxml import etree
+import lxml.html
+import operator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import gzip
 import json
+import sqlite3
+import threading
+import time
+
+try:
+    import orjson # much faster than json on the large cache file
+except ImportError:
+    orjson = None
 import secrets # file that contains your API key
 
 
-CACHE_FILENAME = "nps_cache.json"
-CACHE_DICT = {}
+CACHE_FILENAME = "nps_cache.sqlite"
+# cached pages older than this many seconds are revalidated with nps.gov
+CACHE_MAX_AGE = 24 * 60 * 60
 
 BASEURL = "https://www.nps.gov"
 
+# park pages are fetched concurrently; the lock guards the cache database
+# and _IN_FLIGHT, which maps a URL being fetched to the Future of its body.
+# MAX_WORKERS caps how many requests are sent to nps.gov at once
+MAX_WORKERS = 20
+_CACHE_LOCK = threading.RLock()
+_IN_FLIGHT = {}
+
+# one session so every request reuses pooled keep-alive connections
+REQUEST_TIMEOUT = 10
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS,
+                       max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+
+def _has_class(cls):
+    '''XPath predicate matching elements whose class list contains cls'''
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+# XPath expressions are compiled once at import and reused for every page
+_STATE_LINKS = etree.XPath(f"(//ul[{_has_class('SearchBar-keywordSearch')}])[1]//a")
+_PARK_HREFS = etree.XPath("//*[@id='list_parks']//h3/a/@href")
+_HERO = etree.XPath(f"//*[{_has_class('Hero-titleContainer')}]")
+_VCARD = etree.XPath(f"//*[{_has_class('vcard')}]")
+_DESIGNATION = etree.XPath(f".//*[{_has_class('Hero-designation')}]")
+_TITLE = etree.XPath(f".//*[{_has_class('Hero-title')}]")
+_LOCALITY = etree.XPath(".//*[@itemprop='addressLocality']")
+_REGION = etree.XPath(".//*[@itemprop='addressRegion']")
+_POSTAL_CODE = etree.XPath(f".//*[{_has_class('postal-code')}]")
+_POSTAL_CODE_ITEMPROP = etree.XPath(".//*[@itemprop='postalCode']")
+_TEL = etree.XPath(f".//*[{_has_class('tel')}]")
+
+
+def _dumps(obj):
+    '''Serialize obj to JSON bytes, using orjson when it is installed'''
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def _loads(data):
+    '''Parse JSON bytes, using orjson when it is installed'''
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+    ''' Opens the cache database, creating it and its table if they
+    don't exist yet
 
     Parameters
     ----------
@@ -25,34 +89,235 @@ def open_cache():
 
     Returns
     -------
-    The opened cache: dict
+    The opened cache: sqlite3.Connection
     '''
-    try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+    # autocommit; WAL keeps each small write cheap but durable
+    conn = sqlite3.connect(CACHE_FILENAME, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS cache(url TEXT PRIMARY KEY, body BLOB, etag TEXT, "
+                 "last_mod TEXT, fetched_at REAL DEFAULT 0, encoding TEXT) WITHOUT ROWID")
+    # older cache databases may lack any of the columns after body
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+    for name, column in (("etag", "etag TEXT"), ("last_mod", "last_mod TEXT"),
+                         ("fetched_at", "fetched_at REAL DEFAULT 0"), ("encoding", "encoding TEXT")):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE cache ADD COLUMN {column}")
+    # fields parsed out of each cached site page
+    conn.execute("CREATE TABLE IF NOT EXISTS sites(url TEXT PRIMARY KEY, category TEXT, name TEXT, "
+                 "address TEXT, zipcode TEXT, phone TEXT) WITHOUT ROWID")
+    return conn
+
+
+CACHE_DB = open_cache()
+atexit.register(CACHE_DB.close)
+
+
+def cache_lookup(key):
+    ''' Looks up an entry in the cache
+
+    Parameters
+    ----------
+    key: string
+        The cache key
+
+    Returns
+    -------
+    tuple
+        (body, etag, last_mod, fetched_at) of the cached entry,
+        or None if key is not cached
+    '''
+    with _CACHE_LOCK:
+        return CACHE_DB.execute("SELECT body, etag, last_mod, fetched_at FROM cache WHERE url=?",
+                                (key,)).fetchone()
+
+
+def cache_insert(key, body, etag=None, last_mod=None, encoding=None):
+    ''' Adds or replaces an entry in the cache
+
+    Parameters
+    ----------
+    key: string
+        The cache key
+    body: bytes
+        The value to cache
+    etag: string
+        The ETag header the body was served with, if any
+    last_mod: string
+        The Last-Modified header the body was served with, if any
+    encoding: string
+        The charset declared in the body's Content-Type header, if any
+
+    Returns
+    -------
+    None
+    '''
+    with _CACHE_LOCK:
+        CACHE_DB.execute("INSERT OR REPLACE INTO cache(url, body, etag, last_mod, fetched_at, encoding) "
+                         "VALUES(?,?,?,?,?,?)", (key, body, etag, last_mod, time.time(), encoding))
+        # anything parsed from the old body is now out of date
+        CACHE_DB.execute("DELETE FROM sites WHERE url=?", (key,))
+
+
+def cache_encoding(key):
+    ''' Looks up the charset a cached page was served with
+
+    Parameters
+    ----------
+    key: string
+        The cache key
+
+    Returns
+    -------
+    string
+        the charset from the page's Content-Type header, or None if it
+        declared none or key is not cached
+    '''
+    with _CACHE_LOCK:
+        row = CACHE_DB.execute("SELECT encoding FROM cache WHERE url=?", (key,)).fetchone()
+    return row[0] if row is not None else None
 
 
-def save_cache(cache_dict):
-    ''' Saves the current state of the cache to disk
+def cache_touch(key):
+    ''' Marks a cache entry as freshly validated
 
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    key: string
+        The cache key
 
     Returns
     -------
     None
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close()
+    with _CACHE_LOCK:
+        CACHE_DB.execute("UPDATE cache SET fetched_at=? WHERE url=?", (time.time(), key))
+
+
+def site_cache_lookup(site_url):
+    ''' Looks up the parsed fields of a site page whose cached HTML
+    is still fresh
+
+    Parameters
+    ----------
+    site_url: string
+        The URL for a national site page in nps.gov
+
+    Returns
+    -------
+    tuple
+        (category, name, address, zipcode, phone), or None if the page
+        has not been parsed or is due for revalidation
+    '''
+    with _CACHE_LOCK:
+        return CACHE_DB.execute("SELECT category, name, address, zipcode, phone FROM sites "
+                                "JOIN cache USING(url) WHERE url=? AND fetched_at>?",
+                                (site_url, time.time() - CACHE_MAX_AGE)).fetchone()
+
+
+def site_cache_insert(site_url, site):
+    ''' Stores the parsed fields of a site page
+
+    Parameters
+    ----------
+    site_url: string
+        The URL for a national site page in nps.gov
+    site: NationalSite
+        The site parsed from that page
+
+    Returns
+    -------
+    None
+    '''
+    with _CACHE_LOCK:
+        CACHE_DB.execute("INSERT OR REPLACE INTO sites VALUES(?,?,?,?,?,?)",
+                         (site_url, site.category, site.name, site.address, site.zipcode, site.phone))
+
+
+def _fetch_page(baseurl, cached):
+    '''Fetch a page, revalidating the cached entry if there is one.
+
+    Sends a conditional GET using the cached ETag/Last-Modified, keeps
+    the cached body on a 304, an error status or a network error, and
+    caches the new body on a successful response.
+
+    Parameters
+    ----------
+    baseurl: string
+        The URL of the page
+    cached: tuple
+        The cache entry for baseurl from cache_lookup, or None
+
+    Returns
+    -------
+    bytes
+        the raw HTML of the page
+    '''
+    headers = {}
+    if cached is not None:
+        body, etag, last_mod = cached[:3]
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_mod:
+            headers['If-Modified-Since'] = last_mod
+
+    try:
+        response = SESSION.get(baseurl, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException:
+        if cached is None:
+            raise
+        print("Using cache")
+        return gzip.decompress(body)
+
+    if cached is not None and response.status_code == 304:
+        print("Using cache")
+        cache_touch(baseurl)
+        return gzip.decompress(body)
+
+    if not response.ok:
+        if cached is None:
+            response.raise_for_status()
+        # leave the entry stale so the next call tries nps.gov again
+        print("Using cache")
+        return gzip.decompress(body)
+
+    print("Fetching")
+    # keep the undecoded bytes plus the charset they were served with, if
+    # the header names one; otherwise lxml detects it from the page
+    content = response.content
+    encoding = None
+    if 'charset' in response.headers.get('Content-Type', '').lower():
+        encoding = requests.utils.get_encoding_from_headers(response.headers)
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            encoding = None
+    cache_insert(baseurl, gzip.compress(content), response.headers.get('ETag'),
+                 response.headers.get('Last-Modified'), encoding)
+    return content
+
+
+def parse_html(html, encoding=None):
+    '''Parse page bytes with lxml.
+
+    Parameters
+    ----------
+    html: bytes
+        The HTML of a page
+    encoding: string
+        The charset the page was served with; if None, lxml detects it
+        from the page itself
+
+    Returns
+    -------
+    lxml.html.HtmlElement
+        the root of the parsed page
+    '''
+    if encoding:
+        return lxml.html.fromstring(html, parser=lxml.html.HTMLParser(encoding=encoding))
+    return lxml.html.fromstring(html)
+
 
 def make_request_with_cache(baseurl):
     '''Check the cache for a saved result for this baseurl+params:values
@@ -66,21 +331,36 @@ def make_request_with_cache(baseurl):
 
     Returns
     -------
-    dict
-        the results of the query as a dictionary loaded from cache
-        JSON
+    bytes
+        the raw body of the response, from the cache or nps.gov
     '''
-    CACHE_DICT = open_cache()
-
-    if baseurl in CACHE_DICT.keys():
+    with _CACHE_LOCK:
+        cached = cache_lookup(baseurl)
+        fresh = cached is not None and time.time() - cached[3] < CACHE_MAX_AGE
+        future = _IN_FLIGHT.get(baseurl)
+        fetching = not fresh and future is None
+        if fetching:
+            future = _IN_FLIGHT[baseurl] = Future()
+
+    if fresh:
         print("Using cache")
-        return CACHE_DICT[baseurl]
+        return gzip.decompress(cached[0])
+
+    elif not fetching:
+        # another thread is already fetching this URL
+        return future.result()
 
     else:
-        print("Fetching")
-        CACHE_DICT[baseurl] = requests.get(baseurl).text
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[baseurl]
+        try:
+            content = _fetch_page(baseurl, cached)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with _CACHE_LOCK:
+                del _IN_FLIGHT[baseurl]
+        future.set_result(content)
+        return content
 
 def make_request(baseurl, params):
     '''Make a request to the Web API using the baseurl and params
@@ -99,9 +379,18 @@ def make_request(baseurl, params):
         a dictionary
     '''
 
-    response = requests.get(baseurl, params=params)
+    response = SESSION.get(baseurl, params=params, timeout=REQUEST_TIMEOUT)
     return response.json()
 
+def _info_field(slot):
+    '''A property over a private NationalSite slot whose setter
+    discards the prebuilt info() string'''
+    def fset(self, value):
+        setattr(self, slot, value)
+        self._info = None
+    return property(operator.attrgetter(slot), fset)
+
+
 class NationalSite:
     '''a national site
 
@@ -123,15 +412,26 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
+    __slots__ = ('_category', '_name', '_address', '_zipcode', 'phone', '_info')
+
+    # the fields shown by info(); assigning one rebuilds it on the next call
+    category = _info_field('_category')
+    name = _info_field('_name')
+    address = _info_field('_address')
+    zipcode = _info_field('_zipcode')
+
     def __init__(self, category, name, address, zipcode, phone):
-        self.category = category
-        self.name = name
-        self.address = address
-        self.zipcode = zipcode
+        self._category = category
+        self._name = name
+        self._address = address
+        self._zipcode = zipcode
         self.phone = phone
+        self._info = f"{name} ({category}): {address} {zipcode}"
 
     def info(self):
-        return f"{self.name} ({self.category}): {self.address} {self.zipcode}"
+        if self._info is None:
+            self._info = f"{self._name} ({self._category}): {self._address} {self._zipcode}"
+        return self._info
 
 
 def build_state_url_dict():
@@ -151,13 +451,11 @@ def build_state_url_dict():
     extension = "/index.htm"
 
     html = make_request_with_cache(BASEURL+extension)
-    soup = BeautifulSoup(html, 'html.parser')
-    search_ul = soup.find('ul', class_ ="dropdown-menu SearchBar-keywordSearch")
-    links_list = search_ul.find_all('a')
-    for link in links_list:
+    tree = parse_html(html, cache_encoding(BASEURL+extension))
+    for link in _STATE_LINKS(tree):
         state_url = link.get('href')
         url = BASEURL+state_url
-        state = link.string.lower()
+        state = link.text_content().lower()
         state_dict[state] = url
     return state_dict
 
@@ -175,41 +473,69 @@ def get_site_instance(site_url):
     instance
         a national site instance
     '''
+    fields = site_cache_lookup(site_url)
+    if fields is not None:
+        print("Using cache")
+        return NationalSite(*fields)
+
     html = make_request_with_cache(site_url)
-    soup = BeautifulSoup(html, 'html.parser')
+    # a 304 revalidation leaves the parsed fields valid, so check again
+    fields = site_cache_lookup(site_url)
+    if fields is not None:
+        return NationalSite(*fields)
 
-    header = soup.find(class_='Hero-titleContainer clearfix')
-    footer = soup.find(class_='vcard')
+    site = parse_site_html(html, cache_encoding(site_url))
+    site_cache_insert(site_url, site)
+    return site
+
+
+def parse_site_html(html, encoding=None):
+    '''Make a national site instance from the HTML of its nps.gov page.
+
+    Parameters
+    ----------
+    html: bytes
+        The HTML of a national site page in nps.gov
+    encoding: string
+        The charset the page was served with, if known
+
+    Returns
+    -------
+    instance
+        a national site instance
+    '''
+    tree = parse_html(html, encoding)
+
+    header = _HERO(tree)[0]
+    footer = _VCARD(tree)[0]
 
     #category
-    try:
-        if header.find(class_='Hero-designation').text == '':
-            category = "No category"
-        elif header.find(class_='Hero-designation') != '':
-            category = header.find(class_='Hero-designation').text.strip()
-    except:
+    designation = _DESIGNATION(header)
+    if designation:
+        category = designation[0].text_content().strip() or "No category"
+    else:
         category = "No category"
 
     #name
-    name = header.find(class_='Hero-title').text.strip()
+    name = _TITLE(header)[0].text_content().strip()
 
     #address
-    try:
-        address = footer.find(itemprop='addressLocality').text.strip() + ', ' + footer.find(itemprop='addressRegion').text.strip()
-    except:
+    locality = _LOCALITY(footer)
+    region = _REGION(footer)
+    if locality and region:
+        address = locality[0].text_content().strip() + ', ' + region[0].text_content().strip()
+    else:
         address = "No address"
 
     #zipcode
-    try:
-        if footer.find(class_='postal-code'):
-            zipcode = footer.find(class_='postal-code').text.strip()
-        elif footer.find(class_='postal-code') == None:
-            zipcode = footer.find(itemprop='postalCode').text.strip()
-    except:
+    postal_code = _POSTAL_CODE(footer) or _POSTAL_CODE_ITEMPROP(footer)
+    if postal_code:
+        zipcode = postal_code[0].text_content().strip()
+    else:
         zipcode = "No zipcode"
 
     #phone
-    phone = footer.find(class_='tel').text.strip()
+    phone = _TEL(footer)[0].text_content().strip()
 
     return NationalSite(category=category, name=name, address=address, zipcode=zipcode, phone=phone)
 
@@ -228,20 +554,13 @@ def get_sites_for_state(state_url):
     list
         a list of national site instances
     '''
-    national_site_list = []
-
     response = make_request_with_cache(state_url)
-    soup = BeautifulSoup(response, 'html.parser')
-
-    parks = soup.find(id="list_parks").find_all('h3')
-    # print(parks)
+    hrefs = _PARK_HREFS(parse_html(response, cache_encoding(state_url)))
+    park_urls = [BASEURL+park_href+'index.htm' for park_href in hrefs]
 
-    for park in parks:
-        park_a = park.find('a')
-        park_href = park_a.get('href')
-        park_url = BASEURL+park_href+'index.htm'
-        # print(park_url)
-        national_site_list.append(get_site_instance(park_url))
+    # overlap the network round-trips of pages that aren't parsed yet
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        national_site_list = list(executor.map(get_site_instance, park_urls))
 
     return national_site_list
 
@@ -270,15 +589,16 @@ def get_nearby_places(site_object):
     }
 
     unique_key = site_object.zipcode
-    if unique_key in CACHE_DICT.keys():
+    cached = cache_lookup(unique_key)
+    if cached is not None:
         print("Using Cache")
-        return CACHE_DICT[unique_key]
+        return _loads(cached[0])
 
     else:
         print("Fetching")
-        CACHE_DICT[unique_key] = make_request(url, params=params)
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[unique_key]
+        result = make_request(url, params=params)
+        cache_insert(unique_key, _dumps(result))
+        return result
 
 
 
@@ -287,13 +607,14 @@ if __name__ == "__main__":
 
     while True:
         state = input(f'\nEnter a U.S. state name (e.g. Michigan, michigan) or "exit": ')
-        if state.lower() == 'exit':
+        state_key = state.lower()
+        if state_key == 'exit':
             break
-        elif state.lower() not in state_dict.keys():
+        elif state_key not in state_dict:
             print(f"\n[ERROR] Enter a proper U.S. state name.")
             continue
         else:
-            url = state_dict[state.lower()]
+            url = state_dict[state_key]
             sites_dict = get_sites_for_state(url)
             header = f"List of National Sites in {state.title()}"
             print('-' * len(header))
@@ -319,20 +640,10 @@ if __name__ == "__main__":
                     for info in result:
                         name = info['name']
                         field = info['fields']
-                        if field['group_sic_code_name'] != '':
-                            category = field['group_sic_code_name']
-                        else:
-                            category = 'no category'
-                        if field['address'] != '':
-                            address = field['address']
-                        else:
-                            address = 'no address'
-                        if field['city'] != '':
-                            city = field['city']
-                        else:
-                            city = 'no city'
+                        category = field.get('group_sic_code_name') or 'no category'
+                        address = field.get('address') or 'no address'
+                        city = field.get('city') or 'no city'
 
                         print(f"- {name} ({category}): {address}, {city}")
                 else:
                     print(f"\n[ERROR] Invalid input. Please enter a valid integer. ")
-    save_cache(CACHE_DICT)
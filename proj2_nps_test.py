@@ -1,4 +1,15 @@
+import gzip
+import os
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
 import proj2_nps as nps
 
 # SI 507 Fall 2020
@@ -84,5 +95,227 @@ class Test_Part4(unittest.TestCase):
         self.assertEqual(self.near_wy['options']['radius'], 10)
 
 
+class Test_NationalSite(unittest.TestCase):
+    def setUp(self):
+        self.site = nps.NationalSite('National Park', 'Yellowstone', 'Yellowstone National Park, WY',
+                                     '82190-0168', '307-344-7381')
+
+    def test_info_is_built_once(self):
+        self.assertIs(self.site.info(), self.site.info())
+        info = self.site.info()
+        self.site.phone = '307-344-2263'
+        self.assertIs(self.site.info(), info)
+
+    def test_info_follows_field_changes(self):
+        self.assertEqual(self.site.info(), "Yellowstone (National Park): Yellowstone National Park, WY 82190-0168")
+        self.site.name = 'Old Faithful'
+        self.site.zipcode = '82190'
+        self.assertEqual(self.site.info(), "Old Faithful (National Park): Yellowstone National Park, WY 82190")
+
+
+def fake_response(status_code=200, content=b'', headers=None):
+    '''A stand-in for the requests.Response returned by SESSION.get'''
+    response = mock.Mock(status_code=status_code, ok=status_code < 400,
+                         content=content, headers=CaseInsensitiveDict(headers or {}))
+    if not response.ok:
+        response.raise_for_status.side_effect = requests.HTTPError(status_code)
+    return response
+
+
+class OfflineTestCase(unittest.TestCase):
+    '''Runs against a temporary cache database with SESSION.get mocked out'''
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        mock.patch.object(nps, 'CACHE_FILENAME', os.path.join(tmpdir.name, 'cache.sqlite')).start()
+        db = nps.open_cache()
+        self.addCleanup(db.close)
+        mock.patch.object(nps, 'CACHE_DB', db).start()
+        self.get = mock.patch.object(nps.SESSION, 'get').start()
+
+
+class Test_InFlight(OfflineTestCase):
+    url = 'https://www.nps.gov/yell/index.htm'
+
+    def fetch_concurrently(self, result, n=8):
+        '''Fetch url from n threads while the first SESSION.get call is
+        held open, then let that call finish with result'''
+        called = threading.Event()
+        release = threading.Event()
+        waiting = threading.Semaphore(0)
+
+        class CountingFuture(Future):
+            '''Signals each thread that starts waiting on the in-flight fetch'''
+            def result(self, timeout=None):
+                waiting.release()
+                return super().result(timeout)
+        mock.patch.object(nps, 'Future', CountingFuture).start()
+
+        def get(url, headers, timeout):
+            called.set()
+            release.wait()
+            if isinstance(result, Exception):
+                raise result
+            return result
+        self.get.side_effect = get
+
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            futures = [executor.submit(nps.make_request_with_cache, self.url)]
+            called.wait()
+            futures += [executor.submit(nps.make_request_with_cache, self.url) for _ in range(n - 1)]
+            # hold the fetch open until every other thread is waiting on it
+            for _ in range(n - 1):
+                self.assertTrue(waiting.acquire(timeout=10))
+            release.set()
+        return futures
+
+    def test_concurrent_fetches_share_one_request(self):
+        futures = self.fetch_concurrently(fake_response(content=b'<html>yell</html>'))
+        self.assertEqual([f.result() for f in futures], [b'<html>yell</html>'] * 8)
+        self.assertEqual(self.get.call_count, 1)
+        self.assertEqual(nps._IN_FLIGHT, {})
+
+    def test_error_reaches_every_waiting_thread(self):
+        futures = self.fetch_concurrently(requests.ConnectionError('down'))
+        for f in futures:
+            self.assertIsInstance(f.exception(), requests.ConnectionError)
+        self.assertEqual(self.get.call_count, 1)
+        self.assertEqual(nps._IN_FLIGHT, {})
+        self.assertIsNone(nps.cache_lookup(self.url))
+
+
+class Test_Revalidation(OfflineTestCase):
+    url = 'https://www.nps.gov/yell/index.htm'
+
+    def setUp(self):
+        super().setUp()
+        nps.cache_insert(self.url, gzip.compress(b'old'), '"e1"', 'Mon, 01 Mar 2021 00:00:00 GMT')
+        nps.CACHE_DB.execute("UPDATE cache SET fetched_at=0")
+
+    def cached_row(self):
+        body, etag, last_mod, fetched_at = nps.cache_lookup(self.url)
+        return gzip.decompress(body), etag, fetched_at
+
+    def test_fresh_entry_is_not_revalidated(self):
+        nps.cache_touch(self.url)
+        self.assertEqual(nps.make_request_with_cache(self.url), b'old')
+        self.get.assert_not_called()
+
+    def test_304_keeps_body_and_refreshes_entry(self):
+        self.get.return_value = fake_response(304)
+        self.assertEqual(nps.make_request_with_cache(self.url), b'old')
+        headers = self.get.call_args.kwargs['headers']
+        self.assertEqual(headers['If-None-Match'], '"e1"')
+        self.assertEqual(headers['If-Modified-Since'], 'Mon, 01 Mar 2021 00:00:00 GMT')
+        body, etag, fetched_at = self.cached_row()
+        self.assertEqual((body, etag), (b'old', '"e1"'))
+        self.assertGreater(fetched_at, time.time() - nps.CACHE_MAX_AGE)
+
+    def test_200_replaces_body_and_validators(self):
+        self.get.return_value = fake_response(200, b'new', {'ETag': '"e2"'})
+        self.assertEqual(nps.make_request_with_cache(self.url), b'new')
+        body, etag, fetched_at = self.cached_row()
+        self.assertEqual((body, etag), (b'new', '"e2"'))
+        self.assertGreater(fetched_at, 0)
+
+    def test_network_error_keeps_stale_entry(self):
+        self.get.side_effect = requests.ConnectionError('down')
+        self.assertEqual(nps.make_request_with_cache(self.url), b'old')
+        self.assertEqual(self.cached_row(), (b'old', '"e1"', 0))
+
+    def test_error_status_keeps_stale_entry(self):
+        for status_code in (404, 429, 503):
+            self.get.return_value = fake_response(status_code, b'<html>error</html>')
+            self.assertEqual(nps.make_request_with_cache(self.url), b'old')
+            self.assertEqual(self.cached_row(), (b'old', '"e1"', 0))
+
+    def test_error_status_without_cache_raises(self):
+        self.get.return_value = fake_response(503, b'<html>error</html>')
+        with self.assertRaises(requests.HTTPError):
+            nps.make_request_with_cache('https://www.nps.gov/noco/index.htm')
+        self.assertIsNone(nps.cache_lookup('https://www.nps.gov/noco/index.htm'))
+
+
+YELL_HTML = b'''<html><body>
+<div class="Hero-titleContainer clearfix"><a class="Hero-title">Yellowstone</a>
+<span class="Hero-designationContainer"><span class="Hero-designation">National Park</span></span></div>
+<div class="vcard"><span itemprop="addressLocality">Yellowstone National Park</span>,
+<span itemprop="addressRegion">WY</span> <span class="postal-code">82190-0168</span>
+<span class="tel">307-344-7381</span></div>
+</body></html>'''
+
+
+# no <meta charset>, so the encoding is only known from the Content-Type header
+HALE_HTML = '''<html><body>
+<div class="Hero-titleContainer clearfix"><a class="Hero-title">Haleakalā</a>
+<span class="Hero-designation">National Park</span></div>
+<div class="vcard"><span itemprop="addressLocality">Makawao</span>,
+<span itemprop="addressRegion">HI</span> <span class="postal-code">96768</span>
+<span class="tel">808-572-4400</span></div>
+</body></html>'''
+
+
+class Test_SiteCache(OfflineTestCase):
+    url = 'https://www.nps.gov/yell/index.htm'
+
+    def sites_row(self):
+        return nps.CACHE_DB.execute("SELECT name, zipcode FROM sites WHERE url=?", (self.url,)).fetchone()
+
+    def test_parsed_fields_are_reused(self):
+        self.get.return_value = fake_response(200, YELL_HTML)
+        first = nps.get_site_instance(self.url)
+        second = nps.get_site_instance(self.url)
+        self.assertEqual(second.info(), first.info())
+        self.assertEqual(self.get.call_count, 1)
+        self.assertEqual(self.sites_row(), ('Yellowstone', '82190-0168'))
+
+    def test_failed_revalidation_keeps_page_and_fields(self):
+        self.get.return_value = fake_response(200, YELL_HTML)
+        nps.get_site_instance(self.url)
+        nps.CACHE_DB.execute("UPDATE cache SET fetched_at=0")
+
+        self.get.return_value = fake_response(503, b'<html>error</html>')
+        self.assertEqual(nps.make_request_with_cache(self.url), YELL_HTML)
+        self.assertEqual(gzip.decompress(nps.cache_lookup(self.url)[0]), YELL_HTML)
+        self.assertEqual(self.sites_row(), ('Yellowstone', '82190-0168'))
+
+    def test_304_revalidation_skips_parsing(self):
+        self.get.return_value = fake_response(200, YELL_HTML)
+        nps.get_site_instance(self.url)
+        nps.CACHE_DB.execute("UPDATE cache SET fetched_at=0")
+
+        self.get.return_value = fake_response(304)
+        with mock.patch.object(nps, 'parse_site_html', wraps=nps.parse_site_html) as parse:
+            site = nps.get_site_instance(self.url)
+        parse.assert_not_called()
+        self.assertEqual(self.get.call_count, 2)
+        self.assertEqual(site.info(), "Yellowstone (National Park): Yellowstone National Park, WY 82190-0168")
+
+    def test_header_charset_is_used_for_parsing(self):
+        for charset in ('utf-8', 'iso-8859-4'):
+            url = f'https://www.nps.gov/hale/{charset}.htm'
+            self.get.return_value = fake_response(200, HALE_HTML.encode(charset),
+                                                  {'Content-Type': f'text/html; charset={charset}'})
+            self.assertEqual(nps.get_site_instance(url).name, 'Haleakalā')
+            self.assertEqual(nps.cache_encoding(url), charset)
+            self.assertEqual(nps.get_site_instance(url).name, 'Haleakalā')
+
+    def test_missing_charset_is_not_stored(self):
+        self.get.return_value = fake_response(200, YELL_HTML, {'Content-Type': 'text/html'})
+        nps.get_site_instance(self.url)
+        self.assertIsNone(nps.cache_encoding(self.url))
+
+    def test_new_page_body_drops_parsed_fields(self):
+        self.get.return_value = fake_response(200, YELL_HTML)
+        nps.get_site_instance(self.url)
+        nps.CACHE_DB.execute("UPDATE cache SET fetched_at=0")
+
+        self.get.return_value = fake_response(200, YELL_HTML.replace(b'Yellowstone<', b'Yellowstone NP<'))
+        nps.make_request_with_cache(self.url)
+        self.assertIsNone(self.sites_row())
+        self.assertEqual(nps.get_site_instance(self.url).name, 'Yellowstone NP')
+
+
 if __name__ == '__main__':
     unittest.main()